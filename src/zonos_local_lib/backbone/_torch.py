@@ -1,182 +1,505 @@
 # Based on gpt-fast: https://github.com/pytorch-labs/gpt-fast/blob/095b2229ee3a40e379c11f05b94bd6923db63b4b/model.py
+import functools
+
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
 from ..config import BackboneConfig, InferenceParams # Adjusted for relative import
+from ..utils import find_multiple
+
+try:
+    # Triton residual-add + LayerNorm kernel, also used by the mamba_ssm backbone. Optional here.
+    from mamba_ssm.ops.triton.layer_norm import layer_norm_fn
+except ImportError:
+    layer_norm_fn = None
+
+try:
+    from flash_attn import flash_attn_func
+except ImportError:
+    flash_attn_func = None
+
+try:
+    # FlashAttention-3 (Hopper only) ships as a separate `flash_attn_interface` module.
+    from flash_attn_interface import flash_attn_func as flash_attn_3_func
+except ImportError:
+    flash_attn_3_func = None
+
+# `enable_gqa` was added to F.scaled_dot_product_attention in PyTorch 2.5.
+_SDPA_SUPPORTS_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
+
 
+def precompute_freqs_cis(
+    seq_len: int, n_elem: int, base: float = 10000, dtype: torch.dtype = torch.bfloat16
+) -> torch.Tensor:
+    """Returns (seq_len, 2, n_elem): a [cos, cos, ...] row and a [-sin, sin, ...] row per position,
+    laid out against the interleaved (real, imag) pairs of head_dim used by apply_rotary_emb.
 
-def precompute_freqs_cis(seq_len: int, n_elem: int, base: float = 10000) -> torch.Tensor:
+    The angles are computed in float32 and cast once to `dtype`, the dtype RoPE runs in.
+    """
     freqs = 1.0 / (base ** (torch.arange(0, n_elem, 2)[: (n_elem // 2)].float() / n_elem))
     t = torch.arange(seq_len, device=freqs.device)
     freqs = torch.outer(t, freqs)
     freqs_cis = torch.polar(torch.ones_like(freqs), freqs)
-    cache = torch.stack([freqs_cis.real, freqs_cis.imag], dim=-1)
-    return cache
+    cos = freqs_cis.real.repeat_interleave(2, dim=-1)
+    sin = torch.stack([-freqs_cis.imag, freqs_cis.imag], dim=-1).flatten(-2)
+    cache = torch.stack([cos, sin], dim=-2)
+    return cache.to(dtype)
 
 
 def apply_rotary_emb(x: torch.Tensor, freqs_cis: torch.Tensor) -> torch.Tensor:
-    xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
-    freqs_cis = freqs_cis.view(-1, xshaped.size(1), 1, xshaped.size(3), 2)
-    x_out2 = torch.stack(
-        [
-            xshaped[..., 0] * freqs_cis[..., 0] - xshaped[..., 1] * freqs_cis[..., 1],
-            xshaped[..., 1] * freqs_cis[..., 0] + xshaped[..., 0] * freqs_cis[..., 1],
-        ],
-        -1,
-    )
+    """x: (batch_size, seqlen, nheads, head_dim); freqs_cis: (1, seqlen, 1, 2, head_dim) in x's dtype.
+
+    Rotating each (x0, x1) pair is x * cos + (x1, x0) * (-sin, sin), i.e. one swap and one
+    fused multiply-add instead of the separate mul/sub/add/stack ops of the complex product.
+    """
+    cos, sin = freqs_cis.unbind(-2)
+    x_swapped = x.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
+    return torch.addcmul(x * cos, x_swapped, sin)
+
 
-    x_out2 = x_out2.flatten(3)
-    return x_out2.type_as(x)
+@functools.lru_cache(maxsize=None)
+def _flash_attn_for_device(device_index: int):
+    major, _ = torch.cuda.get_device_capability(device_index)
+    if major == 9 and flash_attn_3_func is not None:
+        return flash_attn_3_func
+    # FlashAttention-2 kernels are built for Ampere/Ada (sm8x) and Hopper (sm90); newer architectures fall back to SDPA.
+    if major in (8, 9) and flash_attn_func is not None:
+        return flash_attn_func
+    return None
+
+
+def _flash_attn_for(x: torch.Tensor):
+    """FlashAttention entry point usable for x (sm8x/sm90 CUDA, fp16/bf16), or None to fall back to SDPA."""
+    if not x.is_cuda or x.dtype not in (torch.float16, torch.bfloat16):
+        return None
+    return _flash_attn_for_device(x.device.index)
+
+
+def _decode_attention(
+    q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, attn_mask: torch.Tensor | None = None
+) -> torch.Tensor:
+    """Attention for a single query token, returning (batch_size, 1, num_heads * head_dim).
+
+    q: (batch_size, 1, num_heads, head_dim); k/v: (batch_size, num_heads_kv, seqlen, head_dim).
+    The query heads sharing a K/V head are stacked as rows of one matmul, so GQA needs no K/V
+    expansion, and no causal mask is built since the token attends to the whole cache.
+    `attn_mask` (broadcastable to the scores, True = attend) is only used by CUDA graph steps.
+    """
+    batch_size, _, num_heads, head_dim = q.shape
+    num_heads_kv = k.shape[1]
+    q = q.reshape(batch_size, num_heads_kv, num_heads // num_heads_kv, head_dim) * head_dim**-0.5
+    scores = torch.matmul(q, k.transpose(-1, -2))
+    if attn_mask is not None:
+        scores = scores.masked_fill(~attn_mask, float("-inf"))
+    attn = torch.softmax(scores, dim=-1, dtype=torch.float32).to(q.dtype)
+    return torch.matmul(attn, v).reshape(batch_size, 1, num_heads * head_dim)
+
+
+def _quantize_kv(kv: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization with one absmax scale per cached (token, head) vector."""
+    scales = kv.abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127
+    return (kv / scales).round().clamp(-127, 127).to(torch.int8), scales
+
+
+def _dequantize_kv(kv_int8: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+    return kv_int8.to(scales.dtype) * scales
+
+
+def _write_kv_entries(
+    cache: torch.Tensor, new: torch.Tensor, sequence_start: int | None, cache_position: torch.Tensor | None
+) -> None:
+    """Write `new` into `cache` in place along the sequence dim (-2), either at the Python offset
+    `sequence_start` through a narrowed view or at the device-side `cache_position`."""
+    if cache_position is None:
+        cache.narrow(-2, sequence_start, new.shape[-2]).copy_(new)
+    else:
+        cache.index_copy_(-2, cache_position, new)
 
 
 def _update_kv_cache(
-    k: torch.Tensor, v: torch.Tensor, inference_params: InferenceParams, layer_idx: int
+    k: torch.Tensor,
+    v: torch.Tensor,
+    inference_params: InferenceParams,
+    layer_cache: tuple[torch.Tensor, torch.Tensor | None],
+    cache_position: torch.Tensor | None = None,
+    cache_len: int | None = None,
 ) -> torch.Tensor:
-    """k/v: (batch_size, seqlen, nheads, head_dim) or (batch_size, 1, nheads, head_dim)"""
-    assert layer_idx in inference_params.key_value_memory_dict
-    kv_cache, _ = inference_params.key_value_memory_dict[layer_idx]
+    """k/v: (batch_size, seqlen, nheads, head_dim) or (batch_size, 1, nheads, head_dim)
+
+    `layer_cache` is this layer's (kv_cache, kv_scales) entry of `inference_params.key_value_memory_dict`.
+
+    The cache is stored as (batch_size, 2, nheads, max_seqlen, head_dim), so only the newly
+    written chunk is transposed and the returned (batch_size, 2, nheads, seqlen, head_dim)
+    slice is already in the layout SDPA expects.
+
+    Under CUDA graph capture the write offset can't be a Python int: `cache_position` then holds
+    it on device and the first `cache_len` cached positions are returned.
+    """
+    kv_cache, kv_scales = layer_cache
     # Adjust key and value for inference
     batch_start = inference_params.batch_size_offset
     batch_end = batch_start + k.shape[0]
-    sequence_start = inference_params.seqlen_offset
-    sequence_end = sequence_start + k.shape[1]
+    if cache_position is None:
+        sequence_start = inference_params.seqlen_offset
+        sequence_end = sequence_start + k.shape[1]
+    else:
+        sequence_start, sequence_end = None, cache_len
     assert batch_end <= kv_cache.shape[0]
-    assert sequence_end <= kv_cache.shape[1]
+    assert sequence_end <= kv_cache.shape[3]
     assert kv_cache is not None
-    kv_cache[batch_start:batch_end, sequence_start:sequence_end, 0, ...] = k
-    kv_cache[batch_start:batch_end, sequence_start:sequence_end, 1, ...] = v
-    return kv_cache[batch_start:batch_end, :sequence_end, ...]
+    batch_cache = kv_cache.narrow(0, batch_start, k.shape[0])
+    if kv_scales is None:
+        _write_kv_entries(batch_cache.select(1, 0), k.transpose(1, 2), sequence_start, cache_position)
+        _write_kv_entries(batch_cache.select(1, 1), v.transpose(1, 2), sequence_start, cache_position)
+        return batch_cache.narrow(3, 0, sequence_end)
+
+    # INT8 cache: quantize only the new entries, and hand back the attended range dequantized
+    # to the compute dtype (the dtype of the scales).
+    new_kv_int8, new_scales = _quantize_kv(torch.stack([k.transpose(1, 2), v.transpose(1, 2)], dim=1))
+    batch_scales = kv_scales.narrow(0, batch_start, k.shape[0])
+    _write_kv_entries(batch_cache, new_kv_int8, sequence_start, cache_position)
+    _write_kv_entries(batch_scales, new_scales, sequence_start, cache_position)
+    return _dequantize_kv(batch_cache.narrow(3, 0, sequence_end), batch_scales.narrow(3, 0, sequence_end))
 
 
 class TorchZonosBackbone(nn.Module):
     supported_architectures = ["transformer"]
     freqs_cis: torch.Tensor
+    # Set to True to replay single-token CUDA decode steps from CUDA graphs (see `decode_step`).
+    use_cuda_graphs = False
+    # Decode graphs attend over the cache rounded up to a multiple of this many positions.
+    cuda_graph_bucket_size = 256
 
     def __init__(self, config: BackboneConfig):
         assert not config.ssm_cfg, "This backbone implementation only supports the Transformer model."
         super().__init__()
         self.config = config
 
-        self.layers = nn.ModuleList(TransformerBlock(config, i) for i in range(config.n_layer))
+        self.layers = nn.ModuleList(TransformerBlock(config) for _ in range(config.n_layer))
         self.norm_f = nn.LayerNorm(config.d_model, eps=config.norm_epsilon)
 
+        self._decode_graphs = {}
+
     def allocate_inference_cache(self, batch_size: int, max_seqlen: int, dtype: torch.dtype = torch.bfloat16):
+        """Passing dtype=torch.int8 stores K/V quantized, halving the cache footprint of a bfloat16 model.
+
+        The int8 cache trades decode speed for memory: every step dequantizes the whole attended range
+        back to the compute dtype, which is extra memory traffic on top of reading the cache. Use it
+        when a bfloat16 cache would not fit, not to make decoding faster.
+        """
         head_dim = self.config.d_model // self.config.attn_cfg["num_heads"]
 
         module_device = self.norm_f.weight.device
+        # RoPE runs in the model's compute dtype, so the table is cast once here rather than upcasting x per layer.
+        module_dtype = self.norm_f.weight.dtype
+        # Attention runs without dtype casts, so a floating-point cache has to match the model.
+        if dtype not in (module_dtype, torch.int8):
+            raise ValueError(f"KV cache dtype {dtype} must match the model dtype {module_dtype} (or be torch.int8).")
 
         # Compute freqs_cis on CPU then move to target device if not already there or on correct device
-        if not hasattr(self, 'freqs_cis') or self.freqs_cis.device != module_device or self.freqs_cis.shape[0] < 16384:
-            cpu_freqs_cis = precompute_freqs_cis(16384, head_dim)
-            self.freqs_cis = cpu_freqs_cis.to(module_device)
+        if (
+            not hasattr(self, 'freqs_cis')
+            or self.freqs_cis.device != module_device
+            or self.freqs_cis.dtype != module_dtype
+            or self.freqs_cis.shape[0] < max_seqlen
+        ):
+            cpu_freqs_cis = precompute_freqs_cis(max_seqlen, head_dim, dtype=module_dtype)
+            if module_device.type == "cuda":
+                # Upload from pinned memory asynchronously so it overlaps with the cache allocation below;
+                # later kernels on the same stream are ordered after the copy.
+                cpu_freqs_cis = cpu_freqs_cis.pin_memory()
+            self.freqs_cis = cpu_freqs_cis.to(module_device, non_blocking=True)
+
+        # Captured decode graphs point at the previous cache tensors.
+        self._decode_graphs = {}
+        # All decode graphs capture into one memory pool instead of a private pool per bucket. Sharing is
+        # safe as they only ever replay one at a time, and each graph's output stays referenced.
+        self._graph_pool = torch.cuda.graph_pool_handle() if module_device.type == "cuda" else None
+        self._decode_position = torch.zeros(1, dtype=torch.long, device=module_device)
 
         return {
             # Pass module_device to sub-layer cache allocation
-            i: layer.allocate_inference_cache(batch_size, max_seqlen, dtype=dtype, device=module_device)
+            i: layer.allocate_inference_cache(
+                batch_size, max_seqlen, dtype=dtype, device=module_device, compute_dtype=module_dtype
+            )
             for i, layer in enumerate(self.layers)
         }
 
+    def quantize_weights(self, scheme: str = "int8") -> None:
+        """Weight-only quantize the attention and MLP Linears in place with torchao.
+
+        Decode at batch 1 is bound by streaming these weights, so "int8" halves the bytes read per
+        token ("float8" needs an sm89+ GPU). The dequant-GEMM kernels are only fused under
+        torch.compile, e.g. `Zonos.generate(..., disable_torch_compile=False)`.
+        """
+        schemes = ("int8", "float8")
+        if scheme not in schemes:
+            raise ValueError(f"Unsupported weight quantization scheme: {scheme}. Expected one of {list(schemes)}.")
+        try:
+            from torchao.quantization import Float8WeightOnlyConfig, Int8WeightOnlyConfig, quantize_
+        except ImportError as e:
+            raise ImportError("quantize_weights requires torchao (pip install torchao).") from e
+
+        config = Int8WeightOnlyConfig() if scheme == "int8" else Float8WeightOnlyConfig()
+        # in_proj/out_proj/fc1/fc2 are the only Linears in the blocks, and none has a bias.
+        quantize_(self.layers, config)
+
+    def compile_layers(self, mode: str | None = None, fullgraph: bool = False, backend: str = "inductor") -> None:
+        """Compile each TransformerBlock separately with torch.compile.
+
+        Compiling per block with dynamic shapes keeps the growing cache length from forcing
+        recompiles of the whole backbone, while Inductor fuses the norms, RoPE, residual adds and
+        SwiGLU inside a block. Opt-in, as Inductor is not available on every setup (see
+        `Zonos.generate(disable_torch_compile=...)`). Leave `mode` unset when using `decode_step`,
+        which already replays CUDA graphs; "reduce-overhead" would capture graphs of its own.
+        Compiled blocks use the plain residual add + nn.LayerNorm rather than mamba_ssm's Triton
+        `layer_norm_fn`, which dynamo can't trace, so `fullgraph=True` works with or without it.
+
+        All blocks share one compiled forward: they hold no per-layer ints (dynamo would specialize
+        on those and recompile for every layer, running the blocks past its recompile limit
+        uncompiled), and each gets its KV cache entry passed in by the backbone instead.
+        """
+        for layer in self.layers:
+            layer.compile(backend=backend, mode=mode, fullgraph=fullgraph, dynamic=True)
+
+    def compact_inference_cache(self, inference_params: InferenceParams, keep: torch.Tensor) -> None:
+        """Drop finished requests from the cache so later decode steps only run the remaining ones.
+
+        `keep` holds the batch indices to retain, in their new order. The batch dimension is
+        outermost, so every request's cache is a contiguous block and this is one gather per layer.
+        The caller must drop the same rows from the hidden states it feeds to `forward`.
+
+        With classifier-free guidance the cache rows are [cond; uncond] (`Zonos` repeats the batch
+        twice), so request i owns rows i and i + batch_size and both must be kept or dropped together,
+        e.g. `keep = torch.cat([kept, kept + batch_size])`. The cache must not be shared with other
+        batches through `batch_size_offset`, which has to be 0.
+        """
+        if inference_params.batch_size_offset != 0:
+            raise ValueError("compact_inference_cache requires inference_params.batch_size_offset == 0.")
+        keep = keep.to(self.norm_f.weight.device)
+        for layer_idx, (kv_cache, kv_scales) in inference_params.key_value_memory_dict.items():
+            if kv_scales is not None:
+                kv_scales = kv_scales.index_select(0, keep)
+            inference_params.key_value_memory_dict[layer_idx] = (kv_cache.index_select(0, keep), kv_scales)
+        if inference_params.lengths_per_sample is not None:
+            inference_params.lengths_per_sample = inference_params.lengths_per_sample.index_select(0, keep)
+        inference_params.max_batch_size = keep.numel()
+        self._decode_graphs = {}
+
     def forward(self, hidden_states: torch.Tensor, inference_params: InferenceParams) -> torch.Tensor:
-        current_device = hidden_states.device
         current_seq_len = hidden_states.shape[1]
         start_pos = inference_params.seqlen_offset
         if not hasattr(self, 'freqs_cis'):
             # This should not happen if allocate_inference_cache was called
             raise RuntimeError("freqs_cis not initialized. Call allocate_inference_cache first.")
 
-        # RoPE positions are relative to the start of the sequence segment
-        # Ensure positions are created on the same device as self.freqs_cis for indexing
-        positions = torch.arange(start_pos, start_pos + current_seq_len, device=self.freqs_cis.device)
-
-        # Slice self.freqs_cis to get frequencies for the current range of positions
-        # freqs_cis_for_layer will have shape [current_seq_len, num_rope_features, 2]
-        freqs_cis_for_layer = self.freqs_cis[positions]
-
-        # Ensure freqs_cis_for_layer is on the same device as hidden_states
-        # (self.freqs_cis should already be on current_device via allocate_inference_cache logic)
-        freqs_cis_for_layer = freqs_cis_for_layer.to(current_device)
+        if (
+            self.use_cuda_graphs
+            and current_seq_len == 1
+            and hidden_states.device.type == "cuda"
+            and not torch.compiler.is_compiling()
+        ):
+            return self.decode_step(hidden_states, inference_params)
+
+        # RoPE positions are relative to the start of the sequence segment, so the frequencies are a
+        # contiguous view of self.freqs_cis (already on the module's device), reshaped once for all
+        # layers to [1, current_seq_len, 1, 2, head_dim], broadcastable against q/k heads.
+        freqs_cis_for_layer = self.freqs_cis.narrow(0, start_pos, current_seq_len).unsqueeze(1).unsqueeze(0)
+
+        for layer_idx, layer in enumerate(self.layers):
+            layer_cache = inference_params.key_value_memory_dict[layer_idx]
+            hidden_states = layer(hidden_states, inference_params, freqs_cis_for_layer, layer_cache)
+        return self.norm_f(hidden_states)
 
-        for i, layer in enumerate(self.layers):
-            hidden_states = layer(hidden_states, inference_params, freqs_cis_for_layer)
+    def decode_step(self, hidden_states: torch.Tensor, inference_params: InferenceParams) -> torch.Tensor:
+        """Run a single-token decode step by replaying a CUDA graph.
+
+        Graphs are captured per (batch_size, batch_size_offset, cache bucket). The write position is
+        read from a device tensor and attention covers the cache up to the bucket end with the
+        not-yet-written tail masked out, so one graph serves every step within a bucket.
+        """
+        batch_size, seqlen, _ = hidden_states.shape
+        assert seqlen == 1, "decode_step only handles single-token steps."
+        position = inference_params.seqlen_offset
+        if position + 1 > inference_params.max_seqlen:
+            raise ValueError(f"Decode position {position} is past the end of the KV cache ({inference_params.max_seqlen}).")
+        bucket = min(find_multiple(position + 1, self.cuda_graph_bucket_size), inference_params.max_seqlen)
+        self._decode_position.fill_(position)
+
+        key = (batch_size, inference_params.batch_size_offset, bucket)
+        if key not in self._decode_graphs:
+            self._decode_graphs[key] = self._capture_decode_graph(hidden_states, inference_params, bucket)
+        graph, static_hidden_states, static_output = self._decode_graphs[key]
+
+        static_hidden_states.copy_(hidden_states)
+        graph.replay()
+        return static_output.clone()
+
+    def _capture_decode_graph(self, hidden_states: torch.Tensor, inference_params: InferenceParams, bucket: int):
+        static_hidden_states = hidden_states.clone()
+
+        # Warm up on a side stream so lazy initialisation (cuBLAS handles, allocator growth) stays out of the graph.
+        # The warmup writes the same K/V entries that the replay will, so it leaves the cache consistent.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._decode_forward(static_hidden_states, inference_params, bucket)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self._graph_pool):
+            static_output = self._decode_forward(static_hidden_states, inference_params, bucket)
+        return graph, static_hidden_states, static_output
+
+    def _decode_forward(self, hidden_states: torch.Tensor, inference_params: InferenceParams, bucket: int) -> torch.Tensor:
+        # Everything position-dependent comes from self._decode_position so a captured graph stays valid across steps.
+        freqs_cis = self.freqs_cis.index_select(0, self._decode_position).unsqueeze(1).unsqueeze(0)
+        attn_mask = (torch.arange(bucket, device=hidden_states.device) <= self._decode_position).view(1, 1, 1, bucket)
+        for layer_idx, layer in enumerate(self.layers):
+            hidden_states = layer(
+                hidden_states,
+                inference_params,
+                freqs_cis,
+                inference_params.key_value_memory_dict[layer_idx],
+                cache_position=self._decode_position,
+                attn_mask=attn_mask,
+            )
         return self.norm_f(hidden_states)
 
 
 class TransformerBlock(nn.Module):
-    def __init__(self, config: BackboneConfig, layer_idx: int) -> None:
+    def __init__(self, config: BackboneConfig) -> None:
         super().__init__()
         self.config = config
 
         self.norm = nn.LayerNorm(config.d_model, eps=config.norm_epsilon)
-        self.mixer = Attention(config, layer_idx)
+        self.mixer = Attention(config)
         self.norm2 = nn.LayerNorm(config.d_model, eps=config.norm_epsilon)
         self.mlp = FeedForward(config)
 
         self.num_heads_kv = config.attn_cfg["num_heads_kv"]
         self.head_dim = config.d_model // config.attn_cfg["num_heads"]
 
-    def allocate_inference_cache(self, batch_size: int, max_seqlen: int, dtype: torch.dtype = torch.bfloat16, device: torch.device = None): # Add device param
-        return torch.empty(batch_size, max_seqlen, 2, self.num_heads_kv, self.head_dim, dtype=dtype, device=device), None # Use device
-
-    def forward(self, x: torch.Tensor, inference_params: InferenceParams, freqs_cis: torch.Tensor) -> torch.Tensor:
-        x = x + self.mixer(self.norm(x), inference_params, freqs_cis)
-        x = x + self.mlp(self.norm2(x))
+    def allocate_inference_cache(
+        self,
+        batch_size: int,
+        max_seqlen: int,
+        dtype: torch.dtype = torch.bfloat16,
+        device: torch.device = None,
+        compute_dtype: torch.dtype = torch.bfloat16,
+    ):
+        # Zeroed rather than left uninitialised: CUDA graph decode steps attend over not-yet-written
+        # positions (masked out of the softmax, but still multiplied into the output), so stale NaN/inf
+        # bytes there would poison every step.
+        kv_cache = torch.zeros(batch_size, 2, self.num_heads_kv, max_seqlen, self.head_dim, dtype=dtype, device=device)
+        if dtype != torch.int8:
+            return kv_cache, None
+        # One scale per cached token and head, kept in the compute dtype K/V are dequantized to.
+        kv_scales = torch.zeros(batch_size, 2, self.num_heads_kv, max_seqlen, 1, dtype=compute_dtype, device=device)
+        return kv_cache, kv_scales
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        inference_params: InferenceParams,
+        freqs_cis: torch.Tensor,
+        layer_cache: tuple[torch.Tensor, torch.Tensor | None],
+        cache_position: torch.Tensor | None = None,
+        attn_mask: torch.Tensor | None = None,
+    ) -> torch.Tensor:
+        attn_out = self.mixer(self.norm(x), inference_params, freqs_cis, layer_cache, cache_position, attn_mask)
+        if layer_norm_fn is not None and x.is_cuda and not torch.compiler.is_compiling():
+            # Fused residual add + norm2: a single read of the residual stream instead of an add and a separate norm.
+            # Under torch.compile the Triton kernel would be a graph break, and Inductor fuses the plain path anyway.
+            normed, x = layer_norm_fn(
+                attn_out, self.norm2.weight, self.norm2.bias, residual=x, eps=self.norm2.eps, prenorm=True
+            )
+        else:
+            x = x + attn_out
+            normed = self.norm2(x)
+        x = x + self.mlp(normed)
         return x
 
 
 class Attention(nn.Module):
-    def __init__(self, config: BackboneConfig, layer_idx: int):
+    def __init__(self, config: BackboneConfig):
         super().__init__()
         self.num_heads = config.attn_cfg["num_heads"]
         self.num_heads_kv = config.attn_cfg["num_heads_kv"]
         self.head_dim = config.d_model // self.num_heads
-        self.layer_idx = layer_idx
+
+        if self.num_heads % self.num_heads_kv != 0:
+            raise ValueError(f"num_heads ({self.num_heads}) must be divisible by num_heads_kv ({self.num_heads_kv}) for GQA.")
+
+        # Shape constants used every step, fixed here so forward (and torch.compile) see plain ints.
+        self.q_size = self.num_heads * self.head_dim
+        # in_proj output heads -> (q and k, v), then the rotated q/k heads -> (q, k)
+        self.split_sizes = (self.num_heads + self.num_heads_kv, self.num_heads_kv)
+        self.qk_split_sizes = (self.num_heads, self.num_heads_kv)
+        self.needs_gqa = self.num_heads_kv < self.num_heads
+        self.gqa_repeats = self.num_heads // self.num_heads_kv
 
         total_head_dim = (self.num_heads + 2 * self.num_heads_kv) * self.head_dim
         self.in_proj = nn.Linear(config.d_model, total_head_dim, bias=False)
         self.out_proj = nn.Linear(self.num_heads * self.head_dim, config.d_model, bias=False)
 
-    def forward(self, x: torch.Tensor, inference_params: InferenceParams, freqs_cis: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        inference_params: InferenceParams,
+        freqs_cis: torch.Tensor,
+        layer_cache: tuple[torch.Tensor, torch.Tensor | None],
+        cache_position: torch.Tensor | None = None,
+        attn_mask: torch.Tensor | None = None,
+    ) -> torch.Tensor:
+        """`cache_position`/`attn_mask` are only set for CUDA graph decode steps, see TorchZonosBackbone.decode_step."""
         batch_size, seqlen, _ = x.shape
 
-        q_size = self.num_heads * self.head_dim
-        kv_size = self.num_heads_kv * self.head_dim
-        q, k, v = self.in_proj(x).split([q_size, kv_size, kv_size], dim=-1)
-
-        q = q.view(batch_size, seqlen, self.num_heads, self.head_dim)
-        k = k.view(batch_size, seqlen, self.num_heads_kv, self.head_dim)
-        v = v.view(batch_size, seqlen, self.num_heads_kv, self.head_dim)
-
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, freqs_cis)
-
-        kv = _update_kv_cache(k, v, inference_params, self.layer_idx)
-        k_retrieved, v_retrieved = kv.unbind(dim=-3)
-
-        # GQA: Repeat K and V heads if num_heads_kv < num_heads
-        if self.num_heads_kv < self.num_heads:
-            if self.num_heads % self.num_heads_kv != 0:
-                raise ValueError(f"num_heads ({self.num_heads}) must be divisible by num_heads_kv ({self.num_heads_kv}) for GQA.")
-            repeats = self.num_heads // self.num_heads_kv
-            k_retrieved = torch.repeat_interleave(k_retrieved, repeats, dim=2) # dim 2 is head dim before transpose
-            v_retrieved = torch.repeat_interleave(v_retrieved, repeats, dim=2)
-
-        # Ensure q matches k/v dtype.
-        # If model is bfloat16, q, k_retrieved are already bfloat16. If model is float32, they are float32.
-        # This cast handles potential inconsistencies or if q was float() from RoPE.
-        q = q.to(k_retrieved.dtype)
-
-        q_final, k_final, v_final = map(lambda x: x.transpose(1, 2), (q, k_retrieved, v_retrieved))
-
-        # Remove enable_gqa=True as it's not supported / needed in PyTorch 2.7.1
-        y = F.scaled_dot_product_attention(q_final, k_final, v_final, is_causal=seqlen > 1)
-
-        y = y.transpose(1, 2).contiguous().view(batch_size, seqlen, q_size)
-
-        # Cast y to out_proj.weight.dtype before projection.
-        # If model is .to(bfloat16), out_proj.weight is bfloat16. SDPA output y (from bfloat16 inputs) is bfloat16.
-        # This ensures consistency if dtypes somehow diverge or if model is float32.
-        y = self.out_proj(y.to(self.out_proj.weight.dtype))
+        # One fused GEMM for q, k and v, viewed per head and split along the head dim.
+        qk, v = self.in_proj(x).view(batch_size, seqlen, -1, self.head_dim).split(self.split_sizes, dim=2)
+
+        # q and k sit next to each other in the projection output, so RoPE runs once over all
+        # of their heads (they share freqs_cis) and the result is split back into q and k.
+        q, k = apply_rotary_emb(qk, freqs_cis).split(self.qk_split_sizes, dim=2)
+
+        if attn_mask is None:
+            kv = _update_kv_cache(k, v, inference_params, layer_cache)
+        else:
+            kv = _update_kv_cache(k, v, inference_params, layer_cache, cache_position, attn_mask.shape[-1])
+        # k_retrieved/v_retrieved: (batch_size, num_heads_kv, sequence_end, head_dim)
+        k_retrieved, v_retrieved = kv.unbind(dim=1)
+
+        # CUDA graph decode steps need the explicit mask, which FlashAttention doesn't take.
+        flash_attn = _flash_attn_for(q) if attn_mask is None else None
+        if flash_attn is not None:
+            # FlashAttention works on (batch_size, seqlen, heads, head_dim) and groups the K/V heads itself,
+            # so q needs no transpose and the output reshapes straight back to (batch_size, seqlen, q_size).
+            y = flash_attn(q, k_retrieved.transpose(1, 2), v_retrieved.transpose(1, 2), causal=seqlen > 1)
+            if isinstance(y, tuple):  # Some FlashAttention-3 releases also return the softmax LSE.
+                y = y[0]
+            y = y.reshape(batch_size, seqlen, self.q_size)
+        elif seqlen == 1:
+            y = _decode_attention(q, k_retrieved, v_retrieved, attn_mask)
+        else:
+            # GQA: SDPA groups the K/V heads itself on PyTorch >= 2.5. Older versions need them
+            # expanded to num_heads, which still materializes a num_heads-sized copy of K/V here.
+            if self.needs_gqa and not _SDPA_SUPPORTS_GQA:
+                kv_len = k_retrieved.shape[2]
+                k_retrieved = k_retrieved.unsqueeze(2).expand(-1, -1, self.gqa_repeats, -1, -1).reshape(batch_size, self.num_heads, kv_len, self.head_dim)
+                v_retrieved = v_retrieved.unsqueeze(2).expand(-1, -1, self.gqa_repeats, -1, -1).reshape(batch_size, self.num_heads, kv_len, self.head_dim)
+
+            # Only q needs moving to (batch_size, num_heads, seqlen, head_dim); the cache is already laid out that way.
+            q_final = q.transpose(1, 2)
+
+            sdpa_kwargs = dict(enable_gqa=self.needs_gqa) if _SDPA_SUPPORTS_GQA else {}
+            y = F.scaled_dot_product_attention(q_final, k_retrieved, v_retrieved, is_causal=True, **sdpa_kwargs)
+
+            # reshape() only copies when the heads actually need interleaving.
+            y = y.transpose(1, 2).reshape(batch_size, seqlen, self.q_size)
+
+        y = self.out_proj(y)
         return y
 
 
@@ -188,5 +511,7 @@ class FeedForward(nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         y, gate = self.fc1(x).chunk(2, dim=-1)
-        return self.fc2(y * F.silu(gate))
+        # Multiply into the silu output in place, which saves allocating another d_intermediate activation
+        # (the elementwise ops still run separately; they're only fused under compile_layers).
+        return self.fc2(F.silu(gate).mul_(y))
 
@@ -0,0 +1 @@
+# Tests for the vendored Zonos TTS library
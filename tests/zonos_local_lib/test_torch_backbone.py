@@ -0,0 +1,294 @@
+# Tests for the pure-PyTorch Zonos transformer backbone.
+# Verifies the optimized RoPE, KV cache and attention paths against straightforward reference implementations.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+try:
+    import torch
+    import torch.nn.functional as F
+except ImportError:
+    torch = None  # The backbone needs torch; every test below is skipped without it.
+
+if torch is not None:
+    try:
+        from zonos_local_lib.backbone._torch import (
+            TorchZonosBackbone,
+            _decode_attention,
+            _update_kv_cache,
+            apply_rotary_emb,
+            precompute_freqs_cis,
+        )
+        from zonos_local_lib.config import BackboneConfig, InferenceParams
+    except ImportError:
+        # Fallback for running this file directly instead of `python -m unittest discover tests`.
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        project_root_dir = os.path.dirname(os.path.dirname(current_dir))
+        src_dir_path = os.path.join(project_root_dir, "src")
+        if src_dir_path not in sys.path:
+            sys.path.insert(0, src_dir_path)
+        from zonos_local_lib.backbone._torch import (
+            TorchZonosBackbone,
+            _decode_attention,
+            _update_kv_cache,
+            apply_rotary_emb,
+            precompute_freqs_cis,
+        )
+        from zonos_local_lib.config import BackboneConfig, InferenceParams
+
+
+def _reference_freqs_cis(seq_len, n_elem, base=10000):
+    """The original (seq_len, n_elem // 2, 2) table of (cos, sin) pairs."""
+    freqs = 1.0 / (base ** (torch.arange(0, n_elem, 2)[: (n_elem // 2)].float() / n_elem))
+    freqs = torch.outer(torch.arange(seq_len), freqs)
+    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)
+    return torch.stack([freqs_cis.real, freqs_cis.imag], dim=-1)
+
+
+def _reference_rotary_emb(x, freqs_cis):
+    """The original stack-based rotation of each interleaved (x0, x1) pair of head_dim."""
+    xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
+    freqs_cis = freqs_cis.view(-1, xshaped.size(1), 1, xshaped.size(3), 2)
+    x_out = torch.stack(
+        [
+            xshaped[..., 0] * freqs_cis[..., 0] - xshaped[..., 1] * freqs_cis[..., 1],
+            xshaped[..., 1] * freqs_cis[..., 0] + xshaped[..., 0] * freqs_cis[..., 1],
+        ],
+        -1,
+    )
+    return x_out.flatten(3).type_as(x)
+
+
+def _make_backbone(dtype=None, device="cpu", n_layer=2):
+    """A tiny GQA backbone: 4 query heads sharing 2 K/V heads of head_dim 16."""
+    config = BackboneConfig(
+        d_model=64, attn_mlp_d_intermediate=32, n_layer=n_layer, attn_cfg={"num_heads": 4, "num_heads_kv": 2}
+    )
+    torch.manual_seed(0)
+    return TorchZonosBackbone(config).to(device=device, dtype=dtype or torch.float32).eval()
+
+
+def _setup_cache(backbone, batch_size, max_seqlen, dtype):
+    """Mirrors Zonos.setup_cache."""
+    key_value_memory_dict = backbone.allocate_inference_cache(batch_size, max_seqlen, dtype=dtype)
+    lengths_per_sample = torch.zeros(batch_size, dtype=torch.int32, device=backbone.norm_f.weight.device)
+    return InferenceParams(max_seqlen, batch_size, 0, 0, key_value_memory_dict, lengths_per_sample)
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestRotaryEmbedding(unittest.TestCase):
+
+    def test_matches_reference_for_q_and_k_with_different_head_counts(self):
+        batch_size, seqlen, num_heads, num_heads_kv, head_dim = 2, 5, 4, 2, 16
+        start_pos, max_seqlen = 3, 16
+        torch.manual_seed(0)
+        q = torch.randn(batch_size, seqlen, num_heads, head_dim)
+        k = torch.randn(batch_size, seqlen, num_heads_kv, head_dim)
+
+        # Attention rotates q and k together, as one tensor of num_heads + num_heads_kv heads.
+        freqs_cis = precompute_freqs_cis(max_seqlen, head_dim, dtype=torch.float32)
+        freqs_cis = freqs_cis.narrow(0, start_pos, seqlen).unsqueeze(1).unsqueeze(0)
+        q_out, k_out = apply_rotary_emb(torch.cat([q, k], dim=2), freqs_cis).split([num_heads, num_heads_kv], dim=2)
+
+        reference_freqs_cis = _reference_freqs_cis(max_seqlen, head_dim)[start_pos : start_pos + seqlen]
+        torch.testing.assert_close(q_out, _reference_rotary_emb(q, reference_freqs_cis))
+        torch.testing.assert_close(k_out, _reference_rotary_emb(k, reference_freqs_cis))
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestDecodeAttention(unittest.TestCase):
+
+    def _check_against_sdpa(self, attn_mask):
+        batch_size, num_heads, num_heads_kv, kv_len, head_dim = 2, 4, 2, 7, 16
+        torch.manual_seed(0)
+        q = torch.randn(batch_size, 1, num_heads, head_dim)
+        k = torch.randn(batch_size, num_heads_kv, kv_len, head_dim)
+        v = torch.randn(batch_size, num_heads_kv, kv_len, head_dim)
+
+        # Query head h attends to K/V head h // (num_heads // num_heads_kv).
+        repeats = num_heads // num_heads_kv
+        expected = F.scaled_dot_product_attention(
+            q.transpose(1, 2),
+            k.repeat_interleave(repeats, dim=1),
+            v.repeat_interleave(repeats, dim=1),
+            attn_mask=attn_mask,
+        )
+        expected = expected.transpose(1, 2).reshape(batch_size, 1, num_heads * head_dim)
+        torch.testing.assert_close(_decode_attention(q, k, v, attn_mask), expected)
+
+    def test_matches_sdpa_with_grouped_kv_heads(self):
+        self._check_against_sdpa(attn_mask=None)
+
+    def test_matches_sdpa_with_grouped_kv_heads_and_mask(self):
+        # The mask CUDA graph steps use: attend to the positions written so far.
+        self._check_against_sdpa(attn_mask=(torch.arange(7) <= 4).view(1, 1, 1, 7))
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestCompactInferenceCache(unittest.TestCase):
+
+    def _check_compaction(self, cache_dtype):
+        backbone = _make_backbone(torch.bfloat16)
+        batch_size, prefill_len = 3, 4
+        inference_params = _setup_cache(backbone, batch_size, max_seqlen=16, dtype=cache_dtype)
+        with torch.no_grad():
+            backbone(torch.randn(batch_size, prefill_len, 64, dtype=torch.bfloat16), inference_params)
+        inference_params.seqlen_offset += prefill_len
+        inference_params.lengths_per_sample += torch.tensor([4, 5, 6], dtype=torch.int32)
+
+        # Only the first prefill_len positions have been written.
+        before = {
+            layer_idx: [t.narrow(3, 0, prefill_len).clone() for t in entry if t is not None]
+            for layer_idx, entry in inference_params.key_value_memory_dict.items()
+        }
+        lengths_before = inference_params.lengths_per_sample.clone()
+
+        keep = torch.tensor([2, 0])
+        backbone.compact_inference_cache(inference_params, keep)
+
+        self.assertEqual(inference_params.max_batch_size, 2)
+        self.assertTrue(torch.equal(inference_params.lengths_per_sample, lengths_before[keep]))
+        for layer_idx, entry in inference_params.key_value_memory_dict.items():
+            compacted = [t.narrow(3, 0, prefill_len) for t in entry if t is not None]
+            self.assertEqual(len(compacted), 2 if cache_dtype == torch.int8 else 1)
+            for tensor, tensor_before in zip(compacted, before[layer_idx]):
+                self.assertTrue(torch.equal(tensor, tensor_before[keep]))
+
+    def test_compacts_bfloat16_cache(self):
+        self._check_compaction(torch.bfloat16)
+
+    def test_compacts_int8_cache_with_scales(self):
+        self._check_compaction(torch.int8)
+
+    def test_rejects_nonzero_batch_size_offset(self):
+        backbone = _make_backbone()
+        inference_params = _setup_cache(backbone, 2, max_seqlen=8, dtype=torch.float32)
+        inference_params.batch_size_offset = 1
+        with self.assertRaises(ValueError):
+            backbone.compact_inference_cache(inference_params, torch.tensor([0]))
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestInt8KVCache(unittest.TestCase):
+
+    def _assert_round_trip(self, kv, k, v):
+        expected = torch.stack([k.transpose(1, 2), v.transpose(1, 2)], dim=1)
+        self.assertEqual(kv.shape, expected.shape)
+        # Rounding to the nearest int8 step is off by at most half a step of absmax / 127.
+        max_error = expected.abs().amax(dim=-1, keepdim=True) / 254
+        self.assertTrue(((kv - expected).abs() <= max_error * 1.01 + 1e-6).all())
+
+    def test_round_trip_through_offset_and_cache_position_writes(self):
+        backbone = _make_backbone()
+        batch_size, prefill_len, num_heads_kv, head_dim = 2, 5, 2, 16
+        inference_params = _setup_cache(backbone, batch_size, max_seqlen=8, dtype=torch.int8)
+        layer_cache = inference_params.key_value_memory_dict[0]
+        torch.manual_seed(0)
+
+        # Prefill: written through a narrowed view at seqlen_offset.
+        k = torch.randn(batch_size, prefill_len, num_heads_kv, head_dim)
+        v = torch.randn(batch_size, prefill_len, num_heads_kv, head_dim)
+        self._assert_round_trip(_update_kv_cache(k, v, inference_params, layer_cache), k, v)
+
+        # Decode step: written at a device-side position, as in a CUDA graph step.
+        k_step = torch.randn(batch_size, 1, num_heads_kv, head_dim) * 10
+        v_step = torch.randn(batch_size, 1, num_heads_kv, head_dim) * 10
+        kv = _update_kv_cache(
+            k_step, v_step, inference_params, layer_cache, cache_position=torch.tensor([prefill_len]), cache_len=prefill_len + 1
+        )
+        self._assert_round_trip(kv, torch.cat([k, k_step], dim=1), torch.cat([v, v_step], dim=1))
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestQuantizeWeights(unittest.TestCase):
+
+    def test_rejects_unknown_scheme_before_importing_torchao(self):
+        backbone = _make_backbone()
+        # Raised even where torchao isn't installed, instead of the missing-dependency ImportError.
+        with self.assertRaises(ValueError):
+            backbone.quantize_weights("int4")
+
+
+@unittest.skipIf(
+    torch is None or not getattr(torch._dynamo.config, "inline_inbuilt_nn_modules", False),
+    "needs a torch.compile that inlines nn.Module calls (PyTorch 2.5+)",
+)
+class TestCompileLayers(unittest.TestCase):
+
+    def test_blocks_share_one_compiled_graph(self):
+        from torch._dynamo.utils import counters
+
+        # More blocks than dynamo's default recompile limit of 8.
+        backbone = _make_backbone(n_layer=10)
+        backbone.compile_layers(fullgraph=True, backend="eager")
+        inference_params = _setup_cache(backbone, 2, max_seqlen=16, dtype=torch.float32)
+        torch._dynamo.reset()
+        counters.clear()
+
+        with torch.no_grad():
+            backbone(torch.randn(2, 4, 64), inference_params)
+            self.assertEqual(counters["stats"]["unique_graphs"], 1)
+
+            # Single-token decode takes its own branch in Attention, so it compiles one more graph,
+            # which every later step and every block reuses.
+            inference_params.seqlen_offset = 4
+            for _ in range(2):
+                backbone(torch.randn(2, 1, 64), inference_params)
+                inference_params.seqlen_offset += 1
+            self.assertEqual(counters["stats"]["unique_graphs"], 2)
+
+
+@unittest.skipIf(torch is None or not torch.cuda.is_available(), "CUDA graph decode needs a CUDA device")
+class TestCudaGraphDecode(unittest.TestCase):
+
+    def _check_graph_matches_eager(self, cache_dtype):
+        backbone = _make_backbone(device="cuda")
+        batch_size, prefill_len, max_seqlen = 2, 5, 32
+        torch_empty = torch.empty
+
+        def nan_filled_empty(*args, **kwargs):
+            # Stand-in for uninitialised memory that happens to hold NaN.
+            out = torch_empty(*args, **kwargs)
+            return out.fill_(float("nan")) if out.is_floating_point() else out.fill_(-1)
+
+        with mock.patch.object(torch, "empty", nan_filled_empty):
+            eager_params = _setup_cache(backbone, batch_size, max_seqlen, dtype=cache_dtype)
+            graph_params = _setup_cache(backbone, batch_size, max_seqlen, dtype=cache_dtype)
+
+        torch.manual_seed(0)
+        prefill = torch.randn(batch_size, prefill_len, 64, device="cuda")
+        steps = torch.randn(3, batch_size, 1, 64, device="cuda")
+        with torch.no_grad():
+            for inference_params in (eager_params, graph_params):
+                backbone(prefill, inference_params)
+                inference_params.seqlen_offset += prefill_len
+
+            for step in steps:
+                backbone.use_cuda_graphs = False
+                eager_out = backbone(step, eager_params)
+                backbone.use_cuda_graphs = True
+                graph_out = backbone(step, graph_params)
+                backbone.use_cuda_graphs = False
+                self.assertTrue(torch.isfinite(graph_out).all())
+                torch.testing.assert_close(graph_out, eager_out, rtol=1e-4, atol=1e-4)
+                eager_params.seqlen_offset += 1
+                graph_params.seqlen_offset += 1
+
+    def test_graph_decode_matches_eager_with_nan_filled_memory(self):
+        self._check_graph_matches_eager(torch.float32)
+
+    def test_graph_decode_matches_eager_with_nan_filled_memory_int8(self):
+        self._check_graph_matches_eager(torch.int8)
+
+    def test_decode_past_cache_end_raises(self):
+        backbone = _make_backbone(device="cuda")
+        inference_params = _setup_cache(backbone, 1, max_seqlen=4, dtype=torch.float32)
+        inference_params.seqlen_offset = 4
+        with self.assertRaises(ValueError):
+            backbone.decode_step(torch.randn(1, 1, 64, device="cuda"), inference_params)
+
+
+if __name__ == '__main__':
+    unittest.main()